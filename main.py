@@ -13,74 +13,138 @@ database and has very simple interactions.
 """
 
 from configparser import ConfigParser
-from datetime import timedelta
 import asyncio
 import os
 import sys
+import traceback
+from typing import NamedTuple
 
 from sanic import Sanic
 from sanic.exceptions import NotFound
 from sanic.request import Request
-from sanic.response import html as response_html, redirect
+from sanic.response import html as response_html, redirect, text as response_text
+import aiofiles
 import asyncpg
 
 from notesrv.api import bp
 from notesrv.db import PostgresNoteDOA, BaseNoteDOA
 
-UID_LENGTH = 21
+PRUNE_INTERVAL = 360  # seconds between pruning expired notes
+
+
+class DBConfig(NamedTuple):
+    """
+    Typed view of the [database] section of config.ini, parsed once in main()
+    """
+    mode: str
+    database: str
+    username: str
+    password: str
+    host: str
+    port: int
+    min_pool: int
+    max_pool: int
+
+    @classmethod
+    def from_section(cls, section) -> "DBConfig":
+        return cls(
+            mode=section["mode"],
+            database=section["database"],
+            username=section["username"],
+            password=section["password"],
+            host=section["host"],
+            port=section.getint("port"),
+            min_pool=section.getint("min_pool", 10),
+            max_pool=section.getint("max_pool", 50),
+        )
+
 
 app = Sanic("note")
 app.static("/", "./dist")
 app.blueprint(bp)
 
 
-async def create_asyncpg_doa(database, username, password, host: str="127.0.0.1", port: int=5432):
+async def create_asyncpg_doa(database, username, password, host: str="127.0.0.1", port: int=5432,
+                            min_pool: int=10, max_pool: int=50):
     """
     Simple wrapper to create an asyncpg connection pool.
     """
     pool = await asyncpg.create_pool(
-        ''.join(
-            ("postgres://",
-             username,
-             (":" + password) if password else "",
-             "@",
-             host,
-             ":{}".format(port),
-             "/{}".format(database),
-             )
-        )
+        host=host,
+        port=port,
+        user=username,
+        password=password or None,
+        database=database,
+        min_size=min_pool,
+        max_size=max_pool,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=1024,
+        init=PostgresNoteDOA.warm_connection,
     )
 
     return PostgresNoteDOA(pool)
 
 
+async def _prune_loop(doa: BaseNoteDOA, interval: int):
+    """
+    Prune expired notes every `interval` seconds until cancelled.
+    """
+    while True:
+        try:
+            await doa.prune_expired()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(interval)
+
+
 @app.listener("before_server_start")
 async def init(app, loop):
-    cfg = app.config.config["database"]
+    cfg = app.config.db
 
-    if cfg["mode"] == "postgresql":
+    if cfg.mode == "postgresql":
+        # min_pool and max_pool are totals across all workers, so each worker's pool gets an equal share
+        max_pool = cfg.max_pool // app.config.workers
+        min_pool = min(max(1, cfg.min_pool // app.config.workers), max_pool)
         app.config.doa = await create_asyncpg_doa(
-            cfg["database"],
-            cfg["username"],
-            cfg["password"],
-            cfg["host"],
-            int(cfg["port"]),
+            cfg.database,
+            cfg.username,
+            cfg.password,
+            cfg.host,
+            cfg.port,
+            min_pool,
+            max_pool,
         )
 
     # Insert other database connection types here and follow the amove template for creating app.config.doa
 
     if not hasattr(app.config, "doa"):
-        print("'{}' is an invalid database mode.", cfg["mode"])
+        print("'{}' is an invalid database mode.".format(cfg.mode))
         sys.exit(1)
 
-    async def prune_every(seconds: int, doa: BaseNoteDOA):
-        await doa.prune_expired()
-        await asyncio.sleep(seconds)
-        asyncio.ensure_future(prune_every(seconds, doa), loop=loop)
-
-    asyncio.ensure_future(prune_every(timedelta(minutes=6).total_seconds(), app.config.doa), loop=loop)
     await app.config.doa.create()
 
+    # the index page is served on every visit to "/", so read it once instead of per request.
+    # The web app is deployed separately, so an API-only deployment without it is allowed.
+    try:
+        # read as text: Sanic's html() would encode the repr of a bytes body
+        async with aiofiles.open("./dist/index.html", "r", encoding="utf-8") as fin:
+            app.config.index_html = await fin.read()
+    except FileNotFoundError:
+        app.config.index_html = None
+        print("./dist/index.html was not found, only the API will be served.")
+
+    # keep a reference to the task so it is not garbage collected while pending
+    app.config.prune_task = loop.create_task(_prune_loop(app.config.doa, PRUNE_INTERVAL))
+
+
+@app.listener("before_server_stop")
+async def stop_pruning(app, loop):
+    task = getattr(app.config, "prune_task", None)
+    if task is not None:
+        task.cancel()
+
 
 @app.exception(NotFound)
 async def handle_NotFound(request: Request, exception: Exception):
@@ -89,7 +153,10 @@ async def handle_NotFound(request: Request, exception: Exception):
 
 @app.route("/")
 async def index(request: Request):
-    return response_html(open("./dist/index.html", "r").read())
+    # not raising NotFound here, since its handler redirects back to "/"
+    if request.app.config.index_html is None:
+        return response_text("Not Found", status=404)
+    return response_html(request.app.config.index_html)
 
 
 def main():
@@ -102,6 +169,11 @@ def main():
             password="",
             host="localhost",
             port=5432,
+            min_pool=10,
+            max_pool=50,
+        )
+        config["server"] = dict(
+            workers=0,
         )
         with open("config.ini", "w+") as fout:
             config.write(fout)
@@ -111,9 +183,14 @@ def main():
 
     config = ConfigParser()
     config.read("config.ini")
-    app.config.config = config
+    app.config.db = DBConfig.from_section(config["database"])
+
+    # 0 (the default) starts one worker per CPU; Sanic runs each worker on uvloop when it is installed.
+    # Every worker needs at least one database connection, so there are never more workers than max_pool.
+    workers = config.getint("server", "workers", fallback=0) or os.cpu_count() or 1
+    app.config.workers = max(1, min(workers, app.config.db.max_pool))
 
 
 if __name__ == "__main__":
     main()
-    app.run(host="0.0.0.0", port=8000)
+    app.run(host="0.0.0.0", port=8000, workers=app.config.workers)
@@ -5,7 +5,8 @@ Integrates with the provided DOA to retrieve and create notes.
 
 from sanic import Blueprint
 from sanic.request import Request
-from sanic.response import json as resp_json
+from sanic.response import HTTPResponse
+import ujson
 
 from .db import BaseNoteDOA
 from .exceptions import NoteExpired, NoteNotFound
@@ -13,17 +14,53 @@ from .exceptions import NoteExpired, NoteNotFound
 __all__ = ["bp"]
 
 
-# splattable dicts to be used when creating erroneous or successful responses
-_err = dict(success=False)
-_suc = dict(success=True)
-
 bp = Blueprint("api", url_prefix="/api")
 
 
+def _json_resp(body: bytes, status: int) -> HTTPResponse:
+    """
+    Build a fresh JSON response around an already serialized body.
+    """
+    return HTTPResponse(body_bytes=body, status=status, content_type="application/json")
+
+
+def _dumps(obj) -> bytes:
+    return ujson.dumps(obj).encode()
+
+
+def _load_payload(request: Request):
+    """
+    Parse the request body as a JSON object.
+
+    :param request: request provided by Sanic
+    :return: dict, or None if the body is not a JSON object
+    """
+    try:
+        payload = ujson.loads(request.body)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
 class ResponseErrors:
-    invalid_json = resp_json(dict(**_err, message="Invalid JSON"), status=415)
-    invalid_params = resp_json(dict(**_err, message="Missing Parameters"), status=422)
-    invalid_note = resp_json(dict(**_err, message="The note does not exist or has expired."), status=404)
+    """
+    Error bodies are serialized once; each call returns a new response so none is shared between requests.
+    """
+    _invalid_json = _dumps({"success": False, "message": "Invalid JSON"})
+    _invalid_params = _dumps({"success": False, "message": "Missing Parameters"})
+    _invalid_note = _dumps({"success": False, "message": "The note does not exist or has expired."})
+
+    @classmethod
+    def invalid_json(cls) -> HTTPResponse:
+        return _json_resp(cls._invalid_json, 415)
+
+    @classmethod
+    def invalid_params(cls) -> HTTPResponse:
+        return _json_resp(cls._invalid_params, 422)
+
+    @classmethod
+    def invalid_note(cls) -> HTTPResponse:
+        return _json_resp(cls._invalid_note, 404)
 
 
 @bp.route("/get", methods=["POST"])
@@ -34,22 +71,27 @@ async def api_get(request: Request):
     :param request: request provided by Sanic
     :return:
     """
-    if request.json is None:
-        return ResponseErrors.invalid_json
+    payload = _load_payload(request)
+    if payload is None:
+        return ResponseErrors.invalid_json()
 
-    uid = request.json.get("uid", None)
+    uid = payload.get("uid")
     if not isinstance(uid, str):
-        return ResponseErrors.invalid_params
+        return ResponseErrors.invalid_params()
 
-    doa = request.app.config.doa
-    assert isinstance(doa, BaseNoteDOA)
+    doa = request.app.config.doa  # type: BaseNoteDOA
 
     try:
         note = await doa.get_by_uid(uid)
     except (NoteExpired, NoteNotFound):
-        return ResponseErrors.invalid_note
+        return ResponseErrors.invalid_note()
     else:
-        return resp_json(dict(**_suc, message="Successful", title=note["title"], note=note["note"]), status=200)
+        return _json_resp(_dumps({
+            "success": True,
+            "message": "Successful",
+            "title": note["title"],
+            "note": note["note"],
+        }), 200)
 
 
 @bp.route("/create", methods=["POST"])
@@ -60,19 +102,19 @@ async def api_create(request: Request):
     :param request: request provided by Sanic
     :return:
     """
-    if request.json is None:
-        return ResponseErrors.invalid_json
+    payload = _load_payload(request)
+    if payload is None:
+        return ResponseErrors.invalid_json()
 
-    n, t, e = map(request.json.get, ("note", "title", "expiration"))
-    t = t or "Untitled"
-    e = e or 0
+    n = payload.get("note")
+    t = payload.get("title") or "Untitled"
+    e = payload.get("expiration") or 0
 
     if not n:
-        return ResponseErrors.invalid_params
+        return ResponseErrors.invalid_params()
 
-    doa = request.app.config.doa
-    assert isinstance(doa, BaseNoteDOA)
+    doa = request.app.config.doa  # type: BaseNoteDOA
 
     uid = await doa.create_note(t, n, e)
 
-    return resp_json(dict(**_suc, message="Successful", uid=uid), status=201)
+    return _json_resp(_dumps({"success": True, "message": "Successful", "uid": uid}), 201)
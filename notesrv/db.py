@@ -8,7 +8,7 @@ Postgresql is used by default, but can be extended easily to support other  SQLA
 
 
 from abc import ABC, abstractmethod
-from datetime import datetime as dt, timedelta
+from datetime import timedelta
 from typing import Union
 
 from .exceptions import NoteExpired, NoteNotFound
@@ -17,6 +17,91 @@ import asyncpg
 
 __all__ = ["BaseNoteDOA", "PostgresNoteDOA"]
 
+# note lifetime by expiration mode; any other mode means the note is single-use
+_EXPIRATION_INTERVALS = {
+    1: timedelta(minutes=5),
+    2: timedelta(minutes=20),
+    3: timedelta(hours=1),
+    4: timedelta(hours=4),
+    5: timedelta(hours=24),
+}
+
+# SQL used by PostgresNoteDOA. The exact text is the key of asyncpg's per-connection statement cache,
+# so these constants are shared between the queries and PostgresNoteDOA.warm_connection.
+SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS notes (
+      uid TEXT PRIMARY KEY,
+      title TEXT NOT NULL,
+      note TEXT NOT NULL,
+      created TIMESTAMPTZ NOT NULL DEFAULT now(),
+      expires TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS notes_expires_idx ON notes (expires) WHERE expires IS NOT NULL;
+"""
+
+# Upgrades a notes table created by older versions of the server (surrogate `id` primary key and naive UTC
+# TIMESTAMP columns) to the current schema. Every step is skipped once applied, so this is safe to run on each start.
+SQL_MIGRATE = """
+    DO $$
+    BEGIN
+      IF EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'id') THEN
+        ALTER TABLE notes DROP COLUMN id;
+        ALTER TABLE notes DROP CONSTRAINT IF EXISTS notes_uid_key;
+        ALTER TABLE notes ADD PRIMARY KEY (uid);
+      END IF;
+
+      IF EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'created'
+                   AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE notes ALTER created TYPE TIMESTAMPTZ USING created AT TIME ZONE 'UTC';
+      END IF;
+
+      IF EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'expires'
+                   AND data_type = 'timestamp without time zone') THEN
+        ALTER TABLE notes ALTER expires TYPE TIMESTAMPTZ USING expires AT TIME ZONE 'UTC';
+      END IF;
+
+      IF (SELECT column_default FROM information_schema.columns
+          WHERE table_schema = current_schema() AND table_name = 'notes' AND column_name = 'created') IS NULL THEN
+        ALTER TABLE notes ALTER created SET DEFAULT now();
+      END IF;
+    END
+    $$;
+"""
+
+SQL_GET_CHECK_EXPIRED = "SELECT *, expires < now() AS is_expired FROM notes WHERE uid=$1"
+
+SQL_TAKE_SINGLE_USE = "DELETE FROM notes WHERE uid=$1 AND expires IS NULL RETURNING *"
+
+SQL_INSERT = "INSERT INTO notes (uid, title, note, expires) VALUES ($1, $2, $3, now() + $4::interval)"
+
+SQL_DELETE_UID = "DELETE FROM notes WHERE uid=$1"
+
+# transaction-level advisory lock serializing create() across server processes, since concurrent
+# CREATE TABLE IF NOT EXISTS statements can still collide in PostgreSQL's catalogs
+CREATE_LOCK_KEY = 41
+
+SQL_CREATE_LOCK = "SELECT pg_advisory_xact_lock($1)"
+
+# session-level advisory lock held while pruning so that only one server process prunes at a time
+PRUNE_LOCK_KEY = 42
+
+SQL_PRUNE_LOCK = "SELECT pg_try_advisory_lock($1)"
+
+SQL_PRUNE_UNLOCK = "SELECT pg_advisory_unlock($1)"
+
+SQL_PRUNE = """
+    DELETE FROM notes WHERE uid IN (
+      SELECT uid FROM notes
+      WHERE expires IS NOT NULL AND expires < now()
+      ORDER BY expires
+      LIMIT $1
+      FOR UPDATE SKIP LOCKED
+    ) RETURNING uid
+"""
+
 
 class BaseNoteDOA(ABC):
     """
@@ -38,60 +123,39 @@ class BaseNoteDOA(ABC):
         Meant to be run periodically
         """
 
-    @abstractmethod
-    async def _delete_by_id(self, id: int):
-        """
-        Deletes a Note by ID. Ignore if the Note does not exist.
-        :param id: ID
-        :raises None
-        """
-
-    @abstractmethod
-    async def _get_by_uid(self, uid: str):
-        """
-        Retrieve a note by UID. This should ONLY retrieve.
-
-        :param uid: unique ID
-        :raises None
-        """
-
     @abstractmethod
     async def get_by_uid(self, uid: str):
         """
-        Wrapper around _get_by_uid that should handle deleting based on expiration.
+        Retrieve a note by UID. Single-use notes and expired notes should be deleted as part of the lookup.
 
         :param: unique ID
         :raises NoteExpored, NoteNotFound
         """
 
     @abstractmethod
-    async def _create_note(self, uid: str, title: str, note: str, created: dt, expires: Union[dt, None]) -> str:
+    async def _create_note(self, uid: str, title: str, note: str, lifetime: Union[timedelta, None]) -> str:
         """
-        Creates a note
+        Creates a note. The creation and expiration timestamps are taken from the database clock.
 
         :param uid: unique string ID
         :param title: A readable title for the note (stored in plaintext)
         :param note: The contents of the note. If stored encrypted, do not store the key anywhere.
-        :param created: Timestamp of when it was created.
-        :param expires: Timestamp of note expiration, None if note is single-use
+        :param lifetime: How long after creation the note expires, None if note is single-use
         :return: a string value of the UID created
         """
 
     @staticmethod
-    def expiration_mode_to_time(expiration_mode: int) -> Union[dt, None]:
+    def expiration_mode_to_interval(expiration_mode: int) -> Union[timedelta, None]:
         """
-        Return a timestamp (or None) based on the expiration mode
+        Return a note lifetime (or None) based on the expiration mode
         :param expiration_mode:
-        :return: timestamp or None
+        :return: timedelta or None
         """
-        now = dt.utcnow()
-        return {
-            1: now + timedelta(minutes=5),
-            2: now + timedelta(minutes=20),
-            3: now + timedelta(hours=1),
-            4: now + timedelta(hours=4),
-            5: now + timedelta(hours=24),
-        }.get(expiration_mode, None)
+        try:
+            return _EXPIRATION_INTERVALS.get(expiration_mode, None)
+        except TypeError:
+            # unhashable modes such as lists or objects decoded from JSON
+            return None
 
     async def create_note(self, title: str, note: str, mode: int):
         """
@@ -102,89 +166,105 @@ class BaseNoteDOA(ABC):
         :param mode: Should be 0-5
         :return:
         """
-        return await self._create_note(gen_uid(), title, note, dt.utcnow(), self.expiration_mode_to_time(mode))
+        return await self._create_note(gen_uid(), title, note, self.expiration_mode_to_interval(mode))
 
 
 class PostgresNoteDOA(BaseNoteDOA):
     """
     Database access object for notes.
     Uses an asyncpg connection pool
-
-    Bit of a DRY violation with spawning transactions,
     """
 
-    def __init__(self, pool: asyncpg.pool.Pool):
+    def __init__(self, pool: asyncpg.pool.Pool, prune_batch_size: int=1000, prune_max_cycles: int=100):
+        """
+        :param pool: asyncpg connection pool
+        :param prune_batch_size: maximum number of notes deleted per prune statement
+        :param prune_max_cycles: maximum number of prune statements issued per call to prune_expired
+        """
         self.__pool = pool
+        self.prune_batch_size = prune_batch_size
+        self.prune_max_cycles = prune_max_cycles
 
-        def transaction_wrapper(func):
-            """
-            A helper function that creates a transaction and then executes the func provided.
-            :param func: A callable member of asyncpg.Connection that returns a coroutine
-            :return:
-            """
-            async def wrapped(*args, **kwargs):
-                async with pool.acquire() as conn:
-                    async with conn.transaction():
-                        return await func(conn, *args, **kwargs)
-            return wrapped
-
-        self._execute = transaction_wrapper(asyncpg.Connection.execute)
-        self._executemany = transaction_wrapper(asyncpg.Connection.executemany)
-        self._fetch = transaction_wrapper(asyncpg.Connection.fetch)
-        self._fetchrow = transaction_wrapper(asyncpg.Connection.fetchrow)
-        self._fetchval = transaction_wrapper(asyncpg.Connection.fetchval)
+    # Each helper acquires a pooled connection and runs one statement in PostgreSQL's implicit transaction.
+
+    async def _execute(self, sql: str, *args):
+        async with self.__pool.acquire() as conn:
+            return await conn.execute(sql, *args)
+
+    async def _fetchrow(self, sql: str, *args):
+        async with self.__pool.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    @staticmethod
+    async def warm_connection(conn: asyncpg.Connection):
+        """
+        Prepares the note statements on a new pool connection so that its first request hits the statement cache.
+        Meant to be passed as `init` to asyncpg.create_pool.
+
+        :param conn: newly opened connection
+        """
+        try:
+            for sql in (SQL_GET_CHECK_EXPIRED, SQL_TAKE_SINGLE_USE, SQL_INSERT, SQL_DELETE_UID,
+                        SQL_PRUNE_LOCK, SQL_PRUNE_UNLOCK, SQL_PRUNE):
+                await conn.prepare(sql)
+        except asyncpg.exceptions.UndefinedTableError:
+            # the notes table has not been created yet; statements will be prepared on first use instead
+            pass
 
     @property
     def pool(self) -> asyncpg.pool.Pool:
         return self.__pool
 
     async def create(self):
-        return await self._execute("""
-            CREATE TABLE IF NOT EXISTS notes (
-              id SERIAL PRIMARY KEY,
-              uid TEXT NOT NULL,
-              title TEXT NOT NULL,
-              note TEXT NOT NULL,
-              created TIMESTAMP NOT NULL,
-              expires TIMESTAMP,
-              UNIQUE(uid)
-            )
-        """)
+        async with self.__pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(SQL_CREATE_LOCK, CREATE_LOCK_KEY)
+                await conn.execute(SQL_CREATE)
+                await conn.execute(SQL_MIGRATE)
 
-    async def prune_expired(self):
-        return await self._execute("""
-            DELETE FROM notes WHERE expires < $1
-        """, dt.utcnow())
+    async def prune_expired(self) -> int:
+        """
+        Deletes expired notes oldest-first in batches of `prune_batch_size` so that no single statement holds
+        locks over an unbounded number of rows. Rows locked by a concurrent pruner are skipped.
 
-    async def _delete_by_uid(self, uid: str):
-        return await self._execute("DELETE FROM notes WHERE uid=$1", uid)
+        Does nothing if another connection holds the prune advisory lock; the lock is released by PostgreSQL
+        if the connection holding it drops, so a dying worker cannot stall pruning.
 
-    async def _delete_by_id(self, id: int):
-        return await self._execute("DELETE FROM notes WHERE id=$1", id)
+        :return: the number of notes deleted
+        """
+        deleted = 0
+        async with self.__pool.acquire() as conn:
+            if not await conn.fetchval(SQL_PRUNE_LOCK, PRUNE_LOCK_KEY):
+                return deleted
+            try:
+                for _ in range(self.prune_max_cycles):
+                    rows = await conn.fetch(SQL_PRUNE, self.prune_batch_size)
+                    deleted += len(rows)
+                    if len(rows) < self.prune_batch_size:
+                        break
+            finally:
+                await conn.fetchval(SQL_PRUNE_UNLOCK, PRUNE_LOCK_KEY)
+        return deleted
 
-    async def _get_by_uid(self, uid: str):
-        return await self._fetchrow("SELECT * FROM notes WHERE uid=$1", uid)
+    async def _delete_by_uid(self, uid: str):
+        return await self._execute(SQL_DELETE_UID, uid)
 
-    async def _create_note(self, uid: str, title: str, note: str, created: dt, expires: Union[dt, None]) -> str:
-        await self._execute("""
-            INSERT INTO notes (uid, title, note, created, expires) VALUES ($1, $2, $3, $4, $5)
-        """, uid, title, note, created, expires)
+    async def _create_note(self, uid: str, title: str, note: str, lifetime: Union[timedelta, None]) -> str:
+        await self._execute(SQL_INSERT, uid, title, note, lifetime)
         return uid
 
     async def get_by_uid(self, uid: str) -> asyncpg.Record:
-        row = await self._get_by_uid(uid)
+        # single-use notes are read and deleted atomically, so two clients can never both read one
+        row = await self._fetchrow(SQL_TAKE_SINGLE_USE, uid)
+        if row is not None:
+            return row
+
+        row = await self._fetchrow(SQL_GET_CHECK_EXPIRED, uid)
         if row is None:
             raise NoteNotFound
 
-        uid = row["uid"]
-        now = dt.utcnow()
-        expires = row["expires"] is not None and row["expires"] < now
-        delete = expires or row["expires"] is None
-
-        if delete:
+        if row["is_expired"]:
             await self._delete_by_uid(uid)
-
-        if expires:
             raise NoteExpired
 
         return row
@@ -2,14 +2,15 @@
 Various utility functions used throughout the note server
 """
 
-from random import SystemRandom
+from base64 import urlsafe_b64encode
+from os import urandom
 from string import ascii_letters, digits
-random = SystemRandom()
 
 __all__ = ["UID_LENGTH", "UID_CHARSET", "gen_uid"]
 
-UID_LENGTH = 21
-UID_CHARSET = ascii_letters + digits
+UID_BYTES = 16
+UID_LENGTH = 22  # unpadded url-safe base64 of UID_BYTES
+UID_CHARSET = ascii_letters + digits + "-_"
 
 
 def gen_uid() -> str:
@@ -17,4 +18,4 @@ def gen_uid() -> str:
     Generate a random unique ID
     :return: str (UID)
     """
-    return ''.join(random.choice(UID_CHARSET) for _ in range(UID_LENGTH))
\ No newline at end of file
+    return urlsafe_b64encode(urandom(UID_BYTES)).rstrip(b"=").decode("ascii")